@@ -1,19 +1,247 @@
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import os
+import atexit
+import shutil
+import secrets
+import heapq
+import itertools
 import json
 from bridge.reply import Reply, ReplyType
 from bridge.context import ContextType, Context
 from common.log import logger
 from plugins import register, Plugin, Event, EventContext, EventAction
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
 import hashlib
 import threading
+import weakref
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from io import BytesIO
-from PIL import Image
-import io
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# 链接提取正则，模块加载时编译一次
+URL_PATTERN = re.compile(r"https?://[A-Za-z0-9$%&'()*+,\-./:;<=>?@\[\]^_!]+")
+SHARE_PATTERN = re.compile(r'(?:复制打开抖音|快手|微博|小红书).*?(https?://\S+)')
+
+# 支持的文件类型：MIME类型 -> (媒体类型, 扩展名)
+MIME_EXTENSIONS = {
+    'video/mp4': ('video', '.mp4'),
+    'video/x-flv': ('video', '.flv'),
+    'video/quicktime': ('video', '.mov'),
+    'video/x-ms-wmv': ('video', '.wmv'),
+    'video/x-msvideo': ('video', '.avi'),
+    'image/jpeg': ('image', '.jpg'),
+    'image/png': ('image', '.png'),
+    'image/gif': ('image', '.gif'),
+    'image/webp': ('image', '.webp'),
+    'image/bmp': ('image', '.bmp'),
+}
+
+# 每种媒体类型可能的缓存文件扩展名，用于查找已下载的文件
+MEDIA_EXTENSIONS = {}
+for _kind, _extension in MIME_EXTENSIONS.values():
+    MEDIA_EXTENSIONS.setdefault(_kind, []).append(_extension)
+
+# CDN 返回这些通用类型时，改为按链接路径中的扩展名判断文件类型
+GENERIC_CONTENT_TYPES = frozenset({'', 'application/octet-stream', 'binary/octet-stream'})
+URL_EXTENSIONS = {extension: (kind, extension) for kind, extension in MIME_EXTENSIONS.values()}
+URL_EXTENSIONS['.jpeg'] = ('image', '.jpg')
+
+# 不超过该大小的媒体文件直接在内存中返回，避免写盘后再读一遍
+IN_MEMORY_MAX_BYTES = 32 * 1024 * 1024
+
+# 解析API响应体的大小上限，超出时不做JSON解析
+API_MAX_RESPONSE_BYTES = 1024 * 1024
+
+# 文件大小的显示单位
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB')
+
+# 携带文件对象、需要在发送后关闭的回复类型
+MEDIA_TYPES = frozenset({ReplyType.IMAGE, ReplyType.VIDEO})
+
+# 进程内共享的HTTP会话，按重试配置区分
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+# 服务端 Retry-After 的最长等待时间（秒），避免消息处理线程被长时间挂起
+RETRY_AFTER_MAX_SECONDS = 10
+
+# 单次请求（含全部重试与等待）的总时限（秒），超过后不再发起新的重试
+REQUEST_DEADLINE_SECONDS = 20
+
+# 当前线程正在进行的请求的截止时间（time.monotonic），由 _make_request 设置
+_request_deadline = threading.local()
+
+
+def _deadline_remaining():
+    """当前请求距截止时间的剩余秒数，未设置截止时间时返回 None"""
+    deadline = getattr(_request_deadline, "value", None)
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+class CappedRetry(Retry):
+    """遵守服务端的 Retry-After，但等待时间不超过 RETRY_AFTER_MAX_SECONDS，且整体不超过请求的截止时间"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        retry_after = min(retry_after, RETRY_AFTER_MAX_SECONDS)
+        remaining = _deadline_remaining()
+        return retry_after if remaining is None else min(retry_after, remaining)
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        remaining = _deadline_remaining()
+        return backoff if remaining is None else min(backoff, remaining)
+
+    def is_exhausted(self):
+        # 截止时间已过时视为重试次数用尽，状态码重试会直接返回最后一次响应
+        return super().is_exhausted() or _deadline_remaining() == 0
+
+
+def get_shared_session(max_retries, retry_delay):
+    """获取进程内共享的会话，复用连接池，避免每次请求或插件重载后重新握手"""
+    key = (max_retries, retry_delay)
+    with _shared_sessions_lock:
+        session = _shared_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            # 失败重试交由 urllib3 按指数退避处理
+            retry = CappedRetry(
+                total=max_retries,
+                connect=max_retries,
+                read=max_retries,
+                backoff_factor=retry_delay,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET", "HEAD"]),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=128, max_retries=retry)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                              "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                "Accept": "*/*",
+                "Accept-Encoding": "gzip",
+                "Connection": "keep-alive"
+            })
+            _shared_sessions[key] = session
+    return session
+
+
+# 已解析的配置文件：(路径, 修改时间, 配置内容)，文件未变化时不再重复解析
+_config_cache = None
+
+
+def read_config_file(config_path):
+    """读取配置文件，按修改时间缓存解析结果"""
+    global _config_cache
+    mtime = os.path.getmtime(config_path)
+    if _config_cache is None or _config_cache[:2] != (config_path, mtime):
+        with open(config_path, "rb") as f:
+            _config_cache = (config_path, mtime, json_loads(f.read()))
+    return _config_cache[2]
+
+
+class PendingTask:
+    """待发送任务，index 为下一条要发送的回复位置"""
+    __slots__ = ('task_id', 'replies', 'index', 'receiver')
+
+    def __init__(self, task_id, replies, receiver):
+        self.task_id = task_id
+        self.replies = replies
+        self.index = 0
+        self.receiver = receiver
+
+
+def image_batch_end(replies, start, image_limit):
+    """返回从 start 开始的一批回复的结束位置，每批最多包含 image_limit 张图片
+
+    图片说明排在图片之前，批次在第 image_limit 张图片之后截断，说明始终与图片同批发送
+    """
+    end = start
+    images = 0
+    while end < len(replies) and images < image_limit:
+        if replies[end].type == ReplyType.IMAGE:
+            images += 1
+        end += 1
+    # 剩余回复中已没有图片（如完成提示）时并入本批，不再单独等待一个批次间隔
+    if not any(reply.type == ReplyType.IMAGE for reply in replies[end:]):
+        end = len(replies)
+    return end
+
+
+# 配置项校验规则：(配置路径, 允许的类型, 是否允许为0, 错误说明)
+CONFIG_RULES = (
+    (("cache", "max_size_mb"), (int, float), False, "缓存大小配置错误"),
+    (("cache", "max_age_hours"), (int, float), False, "缓存过期时间配置错误"),
+    (("cache", "api_ttl_seconds"), (int, float), True, "解析结果缓存有效期配置错误"),
+    (("cache", "api_max_entries"), int, True, "解析结果缓存条数配置错误"),
+    (("cache", "chunk_size"), int, False, "下载分块大小配置错误"),
+    (("download", "timeout"), (int, float), False, "下载超时配置错误"),
+    (("download", "max_retries"), int, True, "最大重试次数配置错误"),
+    (("download", "retry_delay"), (int, float), True, "重试延迟配置错误"),
+    (("download", "max_workers"), int, False, "下载线程数配置错误"),
+    (("batch", "image_limit"), int, False, "图集批量发送限制配置错误"),
+    (("batch", "delay_seconds"), (int, float), True, "批次延迟时间配置错误"),
+    (("max_video_size_mb",), (int, float), False, "视频最大大小配置错误"),
+)
+
+# 调度堆中的周期性过期缓存清理任务
+CACHE_CLEANUP_TASK = object()
+
+# 尚未回收的插件实例，进程退出时统一关闭；弱引用不会阻止插件重载后旧实例被回收
+_live_plugins = weakref.WeakSet()
+
+
+def _close_live_plugins():
+    """进程退出时按顺序释放仍存活的插件实例的资源"""
+    for plugin in list(_live_plugins):
+        plugin.close()
+
+
+atexit.register(_close_live_plugins)
+
+
+def _process_pending_tasks(plugin_ref, tasks_cv, pending_tasks, stop_event):
+    """后台线程处理待发送的任务，空闲时阻塞等待，到点才被唤醒
+
+    等待期间只持有插件的弱引用，插件被回收时 __del__ 发出停止信号，线程随之退出
+    """
+    while True:
+        with tasks_cv:
+            while not stop_event.is_set():
+                if not pending_tasks:
+                    tasks_cv.wait()
+                    continue
+                delay = pending_tasks[0][0] - time.monotonic()
+                if delay <= 0:
+                    break
+                tasks_cv.wait(timeout=delay)
+            if stop_event.is_set():
+                return
+            _, _, task = heapq.heappop(pending_tasks)
+        
+        plugin = plugin_ref()
+        if plugin is None:
+            return
+        plugin._run_task(task)
+        del plugin
+
 
 @register(name="media_parser", desc="视频图集解析插件", version="1.4", author="安与", desire_priority=100)
 class MediaParserPlugin(Plugin):
@@ -21,43 +249,56 @@ class MediaParserPlugin(Plugin):
         super().__init__()
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
         
+        # 线程锁用于缓存管理的同步
+        self.cache_lock = threading.Lock()  # 确保这行存在
+        
         # 初始化配置和缓存
         self._load_config()
         self._init_cache()
         
-        # 初始化会话和线程池
-        self.session = requests.Session()
-        self.executor = ThreadPoolExecutor(max_workers=5)  # 增加线程池大小以提高下载效率
+        # 初始化会话和线程池，会话在进程内共享，插件重载后连接池仍然可用
+        self.session = get_shared_session(
+            self.config["download"]["max_retries"], self.config["download"]["retry_delay"])
+        self.executor = ThreadPoolExecutor(max_workers=self.config["download"]["max_workers"])
         
-        # 线程锁用于缓存管理的同步
-        self.cache_lock = threading.Lock()  # 确保这行存在
-        self.tasks_lock = threading.Lock()
+        # 解析结果缓存：(类型, 规范化链接) -> (过期时间, API返回数据)
+        self.api_cache = OrderedDict()
+        self.api_cache_lock = threading.Lock()
         
-        # 支持的文件类型
-        self.video_extensions = {
-            'video/mp4': '.mp4',
-            'video/x-flv': '.flv',
-            'video/quicktime': '.mov',
-            'video/x-ms-wmv': '.wmv',
-            'video/x-msvideo': '.avi',
+        # 命令分发表：完全匹配的命令 -> 处理方法，解析命令按前缀匹配
+        self.text_commands = {
+            "清理缓存": self.clean_cache,
+            "查看缓存": self.cache_status,
         }
+        self.parse_commands = ("解析视频", "解析图集")
+        # 所有命令合并为一个正则，一次匹配同时得到命令和参数
+        self.command_pattern = re.compile(
+            r'^(%s)\s*(.*)$' % "|".join(map(re.escape, [*self.text_commands, *self.parse_commands])),
+            re.S)
         
-        self.image_extensions = {
-            'image/jpeg': '.jpg',
-            'image/png': '.png',
-            'image/gif': '.gif',
-            'image/webp': '.webp',
-            'image/bmp': '.bmp',
-        }
+        # 微信channel，首次发送时创建
+        self.wx_channel = None
+        self.wx_channel_lock = threading.Lock()
         
-        # 记录正在处理的任务
-        self.processing_tasks = {}
+        # 待发送的任务：按下次发送时间排序的堆 (发送时间, 序号, 任务)，发送时间取自 time.monotonic()，不受系统时钟调整影响
+        self.pending_tasks = []
+        self.task_seq = itertools.count()
+        self.tasks_cv = threading.Condition()
         
         # 启动后台线程处理待发送的任务
         self.stop_event = threading.Event()
-        self.worker_thread = threading.Thread(target=self._process_pending_tasks, daemon=True)
+        self.worker_thread = threading.Thread(
+            target=_process_pending_tasks,
+            args=(weakref.ref(self), self.tasks_cv, self.pending_tasks, self.stop_event),
+            daemon=True)
         self.worker_thread.start()
         
+        # 过期缓存清理由后台线程在启动时及之后定期执行
+        self._schedule_task(CACHE_CLEANUP_TASK, time.monotonic())
+        
+        # 进程退出时按顺序释放资源，不依赖垃圾回收的时机
+        _live_plugins.add(self)
+        
         logger.info("[MediaParser] 插件已加载")
 
     def _load_config(self):
@@ -79,7 +320,9 @@ class MediaParserPlugin(Plugin):
             "cache": {
                 "max_size_mb": 500,
                 "max_age_hours": 24,
-                "chunk_size": 8192
+                "chunk_size": 1024 * 1024,
+                "api_ttl_seconds": 1800,  # 解析结果缓存有效期
+                "api_max_entries": 1024   # 解析结果缓存最大条数
             },
             "download": {
                 "timeout": 30,
@@ -96,49 +339,63 @@ class MediaParserPlugin(Plugin):
         
         try:
             if os.path.exists(config_path):
-                with open(config_path, "r", encoding="utf-8") as f:
-                    config = json.load(f)
+                config = read_config_file(config_path)
                 self.config = self._merge_config(self.default_config, config)
             else:
                 self.config = self.default_config
                 with open(config_path, "w", encoding="utf-8") as f:
                     json.dump(self.config, f, indent=4, ensure_ascii=False)
         except Exception as e:
-            logger.warn(f"[MediaParser] 加载配置文件失败: {e}, 使用默认配置")
+            logger.warn("[MediaParser] 加载配置文件失败: %s, 使用默认配置", e)
             self.config = self.default_config
             
+        # 配置验证
+        self._validate_config()
+
         # 设置API endpoints
         self.video_api = self.config["api_endpoints"]["video"]
         self.image_api = self.config["api_endpoints"]["image"]
         self.supported_platforms = self.config.get("supported_platforms", [])
 
-        # 配置验证
-        self._validate_config()
+        # 缓存常用配置项，避免在下载和缓存检查中反复做嵌套字典查找
+        self.download_timeout = self.config["download"]["timeout"]
+        self.chunk_size = self.config["cache"]["chunk_size"]
+        self.max_cache_size = self.config["cache"]["max_size_mb"] * 1024 * 1024
+        self.max_cache_age = self.config["cache"]["max_age_hours"] * 3600
+        self.cache_cleanup_interval = max(self.max_cache_age / 4, 60)
+        self.api_cache_ttl = self.config["cache"]["api_ttl_seconds"]
+        self.api_cache_max_entries = self.config["cache"]["api_max_entries"]
+        self.max_video_size = self.config["max_video_size_mb"] * 1024 * 1024
+        self.batch_size = self.config["batch"]["image_limit"]
+        self.batch_delay = self.config["batch"]["delay_seconds"]
 
     def _validate_config(self):
         """验证配置文件的有效性"""
         try:
-            assert isinstance(self.config["cache"]["max_size_mb"], (int, float)) and self.config["cache"]["max_size_mb"] > 0, "缓存大小配置错误"
-            assert isinstance(self.config["cache"]["max_age_hours"], (int, float)) and self.config["cache"]["max_age_hours"] > 0, "缓存过期时间配置错误"
-            assert isinstance(self.config["download"]["timeout"], (int, float)) and self.config["download"]["timeout"] > 0, "下载超时配置错误"
-            assert isinstance(self.config["download"]["max_retries"], int) and self.config["download"]["max_retries"] >= 0, "最大重试次数配置错误"
-            assert isinstance(self.config["download"]["retry_delay"], (int, float)) and self.config["download"]["retry_delay"] >= 0, "重试延迟配置错误"
-            assert isinstance(self.config["batch"]["image_limit"], int) and self.config["batch"]["image_limit"] > 0, "图集批量发送限制配置错误"
-            assert isinstance(self.config["batch"]["delay_seconds"], (int, float)) and self.config["batch"]["delay_seconds"] >= 0, "批次延迟时间配置错误"
-            assert isinstance(self.config["max_video_size_mb"], (int, float)) and self.config["max_video_size_mb"] > 0, "视频最大大小配置错误"
+            for path, types, allow_zero, message in CONFIG_RULES:
+                value = self.config
+                for key in path:
+                    value = value[key]
+                # bool 是 int 的子类，需要单独排除
+                if isinstance(value, bool) or not isinstance(value, types) or value < 0 or (value == 0 and not allow_zero):
+                    raise ValueError(message)
             logger.info("[MediaParser] 配置文件验证通过")
-        except AssertionError as e:
-            logger.error(f"[MediaParser] 配置文件验证失败: {e}")
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("[MediaParser] 配置文件验证失败: %s", e)
             self.config = self.default_config  # 回退到默认配置
 
     def _merge_config(self, default, custom):
-        """递归合并配置"""
+        """合并配置，嵌套字典逐层合并，只复制被覆盖的子字典"""
         result = default.copy()
-        for key, value in custom.items():
-            if key in result and isinstance(result[key], dict) and isinstance(value, dict):
-                result[key] = self._merge_config(result[key], value)
-            else:
-                result[key] = value
+        stack = [(result, custom)]
+        while stack:
+            target, source = stack.pop()
+            for key, value in source.items():
+                if isinstance(value, dict) and isinstance(target.get(key), dict):
+                    target[key] = target[key].copy()
+                    stack.append((target[key], value))
+                else:
+                    target[key] = value
         return result
 
     def _init_cache(self):
@@ -148,47 +405,60 @@ class MediaParserPlugin(Plugin):
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
         
-        # 启动时清理过期缓存，使用后台线程
-        threading.Thread(target=self._clear_expired_cache, daemon=True).start()
+        # 启动时扫描一次缓存目录建立索引（按创建时间从旧到新），之后在下载和清理时增量维护
+        self.cache_index = OrderedDict()
+        self.cache_total_size = 0
+        for ctime, size, filepath in sorted(self._scan_cache()):
+            if filepath.endswith(".part"):
+                # 上次运行中断留下的临时文件
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+                continue
+            self.cache_index[os.path.basename(filepath)] = (size, ctime)
+            self.cache_total_size += size
 
     def get_help_text(self, **kwargs):
-        help_text = "视频/图集解析插件使用说明：\n"
-        help_text += "1. 发送 '解析视频 <链接>' 获取无水印视频\n"
-        help_text += "2. 发送 '解析图集 <链接>' 获取图集原图\n"
-        help_text += "3. 发送 '清理缓存' 清除临时文件\n"
-        help_text += "4. 发送 '查看缓存' 查看缓存状态\n"
-        help_text += "\n支持批量发送图片，每批最多发送 {} 张\n".format(
-            self.config["batch"]["image_limit"])
+        help_parts = [
+            "视频/图集解析插件使用说明：\n",
+            "1. 发送 '解析视频 <链接>' 获取无水印视频\n",
+            "2. 发送 '解析图集 <链接>' 获取图集原图\n",
+            "3. 发送 '清理缓存' 清除临时文件\n",
+            "4. 发送 '查看缓存' 查看缓存状态\n",
+            "\n支持批量发送图片，每批最多发送 {} 张\n".format(self.batch_size),
+        ]
         if self.supported_platforms:
-            help_text += "\n支持的平台：\n"
-            help_text += "、".join(self.supported_platforms)
-        return help_text
+            help_parts.append("\n支持的平台：\n")
+            help_parts.append("、".join(self.supported_platforms))
+        return "".join(help_parts)
 
     def on_handle_context(self, e_context: EventContext):
         if e_context['context'].type != ContextType.TEXT:
             return
 
         content = e_context['context'].content.strip()
-        logger.info(f"[MediaParser] 收到消息: {content}")
+        logger.info("[MediaParser] 收到消息: %s", content)
         
-        if content == "清理缓存":
-            result = self.clean_cache()
-            e_context['reply'] = Reply(ReplyType.TEXT, result)
-            e_context.action = EventAction.BREAK_PASS
+        match = self.command_pattern.match(content)
+        if not match:
             return
-            
-        elif content == "查看缓存":
-            result = self.cache_status()
+        command, url = match.groups()
+        
+        handler = self.text_commands.get(command)
+        if handler:
+            # 缓存命令需要完全匹配
+            if url:
+                return
+            result = handler()
             e_context['reply'] = Reply(ReplyType.TEXT, result)
             e_context.action = EventAction.BREAK_PASS
             return
 
         # 检查是否是解析命令
-        if content.startswith(("解析视频", "解析图集")):
-            command = "解析视频" if content.startswith("解析视频") else "解析图集"
-            url = content[len(command):].strip()
+        if command in self.parse_commands:
             
-            logger.info(f"[MediaParser] 解析命令: {command}, URL: {url}")
+            logger.info("[MediaParser] 解析命令: %s, URL: %s", command, url)
             
             if not url:
                 e_context['reply'] = Reply(ReplyType.TEXT, f"请提供要解析的链接\n例如：{command} <链接>")
@@ -203,29 +473,33 @@ class MediaParserPlugin(Plugin):
                 e_context.action = EventAction.BREAK_PASS
                 return
             
-            logger.info(f"[MediaParser] 开始处理，接收者: {receiver}")
+            logger.info("[MediaParser] 开始处理，接收者: %s", receiver)
             
             try:
                 # 提取链接中的URL
-                url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-                urls = re.findall(url_pattern, url)
+                url_match = URL_PATTERN.search(url)
                 
-                if not urls:
+                if not url_match:
                     # 尝试从文本中提取分享链接
-                    share_pattern = r'复制打开抖音|快手|微博|小红书.*?(?:https?://[^\s]+)'
-                    share_match = re.search(share_pattern, url)
+                    share_match = SHARE_PATTERN.search(url)
                     if share_match:
-                        share_text = share_match.group(0)
-                        urls = re.findall(url_pattern, share_text)
+                        url_match = URL_PATTERN.search(share_match.group(1))
                 
-                if not urls:
-                    logger.error(f"[MediaParser] 未找到有效链接: {url}")
+                if not url_match:
+                    logger.error("[MediaParser] 未找到有效链接: %s", url)
                     e_context['reply'] = Reply(ReplyType.TEXT, "未找到有效的链接，请确保链接格式正确")
                     e_context.action = EventAction.BREAK_PASS
                     return
                 
-                target_url = urls[0]
-                logger.info(f"[MediaParser] 提取到链接: {target_url}")
+                target_url = url_match.group()
+                logger.info("[MediaParser] 提取到链接: %s", target_url)
+                
+                # 没有主机名的链接无需请求解析API
+                if not urlsplit(target_url).hostname:
+                    logger.error("[MediaParser] 链接缺少域名: %s", target_url)
+                    e_context['reply'] = Reply(ReplyType.TEXT, "未找到有效的链接，请确保链接格式正确")
+                    e_context.action = EventAction.BREAK_PASS
+                    return
                 
                 if command == "解析视频":
                     replies = self.parse_video(target_url)
@@ -237,16 +511,21 @@ class MediaParserPlugin(Plugin):
                 if isinstance(replies, list) and replies:
                     # 将第一个回复设置为主回复
                     e_context['reply'] = replies[0]
-                    # 如果有更多回复，则将它们添加到reply_list中
                     if len(replies) > 1:
-                        for reply in replies[1:]:
-                            self.send_to_channel(reply, receiver)
+                        extra_replies = replies[1:]
+                        if command == "解析图集":
+                            # 图集交给后台线程按 image_limit 分批发送，批次间隔 delay_seconds，发送完成后关闭文件
+                            self.add_task(task_id, extra_replies, receiver)
+                        else:
+                            # 其余回复一次性交给channel发送，发送完成后统一关闭文件
+                            self.send_to_channel(extra_replies, receiver)
+                            self.clean_up_files(extra_replies)
                 else:
                     # 如果只有一个回复或没有回复
                     e_context['reply'] = replies if replies else Reply(ReplyType.TEXT, "解析失败")
                 
             except Exception as e:
-                logger.error(f"[MediaParser] 解析失败: {e}", exc_info=True)
+                logger.error("[MediaParser] 解析失败: %s", e, exc_info=True)
                 e_context['reply'] = Reply(ReplyType.TEXT, "解析失败，请检查链接是否有效")
 
             e_context.action = EventAction.BREAK_PASS
@@ -255,22 +534,8 @@ class MediaParserPlugin(Plugin):
     def parse_video(self, url):
         """解析视频链接"""
         try:
-            # 使用新的聚合解析API
-            video_api = "https://www.hhlqilongzhu.cn/api/sp_jx/sp.php"
-            params = {"url": url}
-            
-            response = self._make_request("GET", video_api, params=params)
-            
-            if not response or response.status_code != 200:
-                msg = f"API请求失败，状态码：{response.status_code}" if response else "API无响应"
-                logger.error(f"[MediaParser] 视频解析API请求失败: {msg}")
-                return [Reply(ReplyType.TEXT, msg)]
-            
-            # 解析响应内容
-            data = response.json()
-            if data.get("code") != 200:
-                error_msg = data.get("msg", "视频解析失败")
-                logger.error(f"[MediaParser] 视频解析失败: {error_msg}")
+            data, error_msg = self._call_api("video", url)
+            if data is None:
                 return [Reply(ReplyType.TEXT, error_msg)]
             
             video_data = data.get("data", {})
@@ -284,19 +549,19 @@ class MediaParserPlugin(Plugin):
                 return [Reply(ReplyType.TEXT, "未找到视频地址")]
             
             self._check_cache_size()
-            file_obj, filename = self.download_media(video_url, "video")
+            file_obj, filename, file_size = self.download_media(video_url, "video", max_size=self.max_video_size)
+            
+            # 检查文件大小并返回提示消息，声明大小超限时不会下载
+            if file_size > self.max_video_size:
+                logger.info("[MediaParser] 视频大小为 %.2fMB，返回提示消息", file_size/(1024*1024))
+                if file_obj:
+                    file_obj.close()
+                return [Reply(ReplyType.TEXT, f"抱歉，该视频文件大于{self.config['max_video_size_mb']}MB，暂时无法处理。请尝试分享较小的视频文件。")]
+            
             if not file_obj:
                 logger.error("[MediaParser] 视频下载失败")
                 return [Reply(ReplyType.TEXT, "视频下载失败")]
             
-            # 检查文件大小并返回提示消息
-            file_size = os.path.getsize(os.path.join(self.cache_dir, filename))
-            max_size = self.config["max_video_size_mb"] * 1024 * 1024
-            if file_size > max_size:
-                logger.info(f"[MediaParser] 视频大小为 {file_size/(1024*1024):.2f}MB，返回提示消息")
-                file_obj.close()
-                return [Reply(ReplyType.TEXT, f"抱歉，该视频文件大于{self.config['max_video_size_mb']}MB，暂时无法处理。请尝试分享较小的视频文件。")]
-            
             # 构建详细的视频描述
             description_parts = []
             
@@ -330,31 +595,20 @@ class MediaParserPlugin(Plugin):
             video_reply.filename = filename
             replies.append(video_reply)
             
-            logger.info(f"[MediaParser] 视频解析成功，描述：{description}")
+            logger.info("[MediaParser] 视频解析成功，描述：%s", description)
             
             return replies
         
         except Exception as e:
-            logger.error(f"[MediaParser] 视频解析出错: {e}", exc_info=True)
+            logger.error("[MediaParser] 视频解析出错: %s", e, exc_info=True)
             return [Reply(ReplyType.TEXT, "视频解析失败，请检查链接是否有效")]
 
     def parse_images(self, url, task_id):
         """解析图集链接"""
         try:
-            # 使用新的聚合解析图集API
-            images_api = "https://www.hhlqilongzhu.cn/api/sp_jx/tuji.php"
-            params = {"url": url}
-            
-            response = self._make_request("GET", images_api, params=params)
-            
-            if not response or response.status_code != 200:
-                msg = f"API请求失败，状态码：{response.status_code}" if response else "API无响应"
-                return Reply(ReplyType.TEXT, msg)
-            
-            # 解析响应内容
-            data = response.json()
-            if data.get("code") != 200:
-                return Reply(ReplyType.TEXT, data.get("msg", "图集解析失败"))
+            data, error_msg = self._call_api("image", url)
+            if data is None:
+                return Reply(ReplyType.TEXT, error_msg)
             
             image_data = data.get("data", {})
             images = image_data.get("images", [])
@@ -363,444 +617,626 @@ class MediaParserPlugin(Plugin):
                 return Reply(ReplyType.TEXT, "未找到图片")
             
             # 记录图片数量
-            logger.info(f"[MediaParser] 获取到 {len(images)} 张图片的URL")
+            logger.info("[MediaParser] 获取到 %s 张图片的URL", len(images))
+            
+            # 拿到图片链接后立即提交全部下载，在下载进行的同时构建描述文本
+            self._check_cache_size()
+            futures = [self.executor.submit(self.download_media, image_url, "image") for image_url in images]
             
             # 准备发送的图片列表
             image_replies = []
+            completed = False
+            try:
+                # 构建详细的图集描述
+                description_parts = []
             
-            # 构建详细的图集描述
-            description_parts = []
-            
-            # 添加作者
-            if image_data.get("author"):
-                description_parts.append(f"👤 作者：{image_data['author']}")
+                # 添加作者
+                if image_data.get("author"):
+                    description_parts.append(f"👤 作者：{image_data['author']}")
             
-            # 添加标题
-            if image_data.get("title"):
-                description_parts.append(f"🖼️ 标题：{image_data['title']}")
+                # 添加标题
+                if image_data.get("title"):
+                    description_parts.append(f"🖼️ 标题：{image_data['title']}")
             
-            # 添加文本信息
-            text_info = image_data.get("text", {})
-            if text_info:
-                description_parts.append(f"📝 信息：{text_info.get('msg', '')}")
-                description_parts.append(f"🕒 时间：{text_info.get('time', '')}")
+                # 添加文本信息
+                text_info = image_data.get("text", {})
+                if text_info:
+                    description_parts.append(f"📝 信息：{text_info.get('msg', '')}")
+                    description_parts.append(f"🕒 时间：{text_info.get('time', '')}")
             
-            # 组合描述
-            description = "\n".join(description_parts)
+                # 组合描述
+                description = "\n".join(description_parts)
             
-            # 发送描述文本
-            if description_parts:
-                text_reply = Reply(ReplyType.TEXT, description)
-                text_reply.receiver = task_id
-                image_replies.append(text_reply)
+                # 发送描述文本
+                if description_parts:
+                    text_reply = Reply(ReplyType.TEXT, description)
+                    text_reply.receiver = task_id
+                    image_replies.append(text_reply)
             
-            # 下载并发送图片
-            for index, img_url in enumerate(images, 1):
-                self._check_cache_size()
-                file_obj, filename = self.download_media(img_url, "image")
-                
-                if file_obj:
-                    # 为每张图片创建单独的图片描述
-                    image_description = f"📸 图片 {index}/{len(images)}"
+                # 按提交顺序取结果，保持图片原有顺序
+                for index, future in enumerate(futures, 1):
+                    file_obj, filename, _ = future.result()
+                    if file_obj:
+                        # 为每张图片创建单独的图片描述
+                        image_description = f"📸 图片 {index}/{len(images)}"
                     
-                    # 创建文本回复
-                    text_reply = Reply(ReplyType.TEXT, image_description)
-                    text_reply.receiver = task_id
+                        # 创建文本回复
+                        text_reply = Reply(ReplyType.TEXT, image_description)
+                        text_reply.receiver = task_id
                     
-                    # 创建图片回复
-                    image_reply = Reply(ReplyType.IMAGE, file_obj)
-                    image_reply.filename = filename
-                    image_reply.receiver = task_id
+                        # 创建图片回复
+                        image_reply = Reply(ReplyType.IMAGE, file_obj)
+                        image_reply.filename = filename
+                        image_reply.receiver = task_id
                     
-                    # 分别发送文本和图片
-                    image_replies.extend([text_reply, image_reply])
+                        # 分别发送文本和图片
+                        image_replies.extend([text_reply, image_reply])
             
-            # 发送完成提示
-            complete_reply = Reply(ReplyType.TEXT, f"图集发送完成，共 {len(images)} 张图片")
-            complete_reply.receiver = task_id
-            image_replies.append(complete_reply)
+                # 发送完成提示
+                complete_reply = Reply(ReplyType.TEXT, f"图集发送完成，共 {len(images)} 张图片")
+                complete_reply.receiver = task_id
+                image_replies.append(complete_reply)
+                completed = True
+            finally:
+                if not completed:
+                    # 中途出错：关闭已取得的文件，取消未开始的下载，进行中的下载完成后立即关闭
+                    self.clean_up_files(image_replies)
+                    for future in futures:
+                        future.cancel()
+                        future.add_done_callback(self._close_download_result)
             
             return image_replies
         
         except Exception as e:
-            logger.error(f"[MediaParser] 图集解析出错: {e}")
+            logger.error("[MediaParser] 图集解析出错: %s", e)
             return Reply(ReplyType.TEXT, "图集解析失败，请检查链接是否有效")
 
-    def _make_request(self, method, url, **kwargs):
-        """发送HTTP请求，支持重试机制"""
-        timeout = self.config["download"]["timeout"]
-        max_retries = self.config["download"]["max_retries"]
-        retry_delay = self.config["download"]["retry_delay"]
+    @staticmethod
+    def _close_download_result(future):
+        """关闭未被使用的下载结果中的文件对象"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        file_obj = future.result()[0]
+        if file_obj:
+            file_obj.close()
+
+    def _call_api(self, kind, url):
+        """调用解析API，返回 (数据, 错误信息)，成功结果会被缓存"""
+        name = "视频" if kind == "video" else "图集"
+        data = self._get_api_cache(kind, url)
+        if data is not None:
+            return data, None
         
-        for i in range(max_retries + 1):
-            try:
-                logger.debug(f"[MediaParser] 发起请求: method={method}, url={url}, kwargs={kwargs}")
-                
-                # 使用会话发送请求
-                response = self.session.request(
-                    method, 
-                    url, 
-                    timeout=timeout, 
-                    **kwargs
-                )
-                
-                # 记录完整的响应信息
-                logger.debug(f"[MediaParser] 响应状态码: {response.status_code}")
-                logger.debug(f"[MediaParser] 响应头: {dict(response.headers)}")
-                
-                # 如果是 JSON 请求，记录 JSON 内容
-                if not kwargs.get('stream'):  # 只在非流式请求时尝试解析JSON
-                    try:
-                        json_data = response.json()
-                        logger.debug(f"[MediaParser] 响应 JSON: {json_data}")
-                    except Exception as json_error:
-                        logger.debug(f"[MediaParser] 解析 JSON 失败: {json_error}")
-                
-                # 检查响应状态码
-                if response.status_code == 200:
-                    return response
-                
-                logger.warning(f"[MediaParser] 请求失败，状态码: {response.status_code}")
-                
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"[MediaParser] 请求失败，将在 {retry_delay} 秒后重试（第 {i+1} 次）: {e}")
-                
-                if i == max_retries:
-                    logger.error(f"[MediaParser] 请求最终失败: {e}")
-                    return None
-                
-                time.sleep(retry_delay)
-            
-            except Exception as e:
-                logger.error(f"[MediaParser] 未知错误: {e}")
+        api = self.video_api if kind == "video" else self.image_api
+        response = self._make_request("GET", api, params={"url": url}, stream=True)
+        if not response or response.status_code != 200:
+            msg = f"API请求失败，状态码：{response.status_code}" if response else "API无响应"
+            logger.error("[MediaParser] %s解析API请求失败: %s", name, msg)
+            return None, msg
+        
+        # 流式读取响应体，累计超过上限即停止，分块传输或 Content-Length 不实时也不会整体读入内存
+        with response:
+            content_length = response.headers.get("content-length", "")
+            too_large = content_length.isdigit() and int(content_length) > API_MAX_RESPONSE_BYTES
+            chunks = []
+            received = 0
+            if not too_large:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    if received > API_MAX_RESPONSE_BYTES:
+                        too_large = True
+                        break
+                    chunks.append(chunk)
+        if too_large:
+            logger.error("[MediaParser] %s解析API响应过大，已忽略", name)
+            return None, f"{name}解析API返回数据异常"
+        
+        # 解析响应内容
+        try:
+            data = json_loads(b"".join(chunks))
+        except ValueError as e:
+            logger.error("[MediaParser] %s解析API返回内容无法解析: %s", name, e)
+            return None, f"{name}解析API返回数据格式错误"
+        if data.get("code") != 200:
+            error_msg = data.get("msg") or f"{name}解析失败"
+            logger.error("[MediaParser] %s解析失败: %s", name, error_msg)
+            return None, error_msg
+        
+        self._set_api_cache(kind, url, data)
+        return data, None
+
+    def _normalize_url(self, url):
+        """规范化链接用作缓存键：去除追踪参数，域名小写"""
+        parts = urlsplit(url)
+        query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                 if not k.startswith("utm_") and k != "share_token"]
+        return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+    def _get_api_cache(self, kind, url):
+        """获取未过期的解析结果缓存"""
+        key = (kind, self._normalize_url(url))
+        with self.api_cache_lock:
+            entry = self.api_cache.get(key)
+            if entry is None:
+                return None
+            expire_at, data = entry
+            if expire_at < time.time():
+                del self.api_cache[key]
                 return None
+            self.api_cache.move_to_end(key)
+        logger.info("[MediaParser] 命中解析结果缓存: %s", url)
+        return data
+
+    def _set_api_cache(self, kind, url, data):
+        """缓存成功的解析结果，超出条数限制时淘汰最久未使用的条目"""
+        if self.api_cache_ttl <= 0 or self.api_cache_max_entries <= 0:
+            return
+        key = (kind, self._normalize_url(url))
+        with self.api_cache_lock:
+            self.api_cache[key] = (time.time() + self.api_cache_ttl, data)
+            self.api_cache.move_to_end(key)
+            while len(self.api_cache) > self.api_cache_max_entries:
+                self.api_cache.popitem(last=False)
+
+    def _make_request(self, method, url, **kwargs):
+        """发送HTTP请求，重试由会话上挂载的 Retry 负责，重试与等待合计不超过 REQUEST_DEADLINE_SECONDS"""
+        _request_deadline.value = time.monotonic() + REQUEST_DEADLINE_SECONDS
+        try:
+            logger.debug("[MediaParser] 发起请求: method=%s, url=%s, kwargs=%s", method, url, kwargs)
+            
+            # 使用会话发送请求
+            response = self.session.request(
+                method, 
+                url, 
+                timeout=self.download_timeout, 
+                **kwargs
+            )
+            
+            # 记录响应信息，响应头按需格式化，JSON 由调用方解析
+            logger.debug("[MediaParser] 响应状态码: %s, 响应头: %s", response.status_code, response.headers)
+            
+            # 检查响应状态码
+            if response.status_code == 200:
+                return response
+            
+            logger.warning("[MediaParser] 请求失败，状态码: %s", response.status_code)
+            response.close()
+            return None
+            
+        except requests.exceptions.RequestException as e:
+            logger.error("[MediaParser] 请求最终失败: %s", e)
+            return None
+        
+        except Exception as e:
+            logger.error("[MediaParser] 未知错误: %s", e)
+            return None
+        
+        finally:
+            # 流式响应体在返回后读取，不涉及重试，截止时间只约束到拿到响应为止
+            _request_deadline.value = None
 
-    def download_media(self, url, media_type="video"):
-        """下载媒体文件，支持视频和图片"""
+    def download_media(self, url, media_type="video", max_size=None):
+        """下载媒体文件，返回 (文件对象, 文件名, 文件大小)；声明大小超过 max_size 时不下载，只返回该大小"""
+        temp_path = None
         try:
-            logger.info(f"[MediaParser] 开始下载{media_type}: {url}")
+            # 以链接的稳定摘要作为文件名，同一链接再次请求时直接复用已下载的文件
+            url_key = hashlib.blake2b(url.encode('utf-8'), digest_size=8).hexdigest()
+            # 通过内存中的缓存索引判断是否已下载，无需逐个扩展名访问文件系统
+            for extension in MEDIA_EXTENSIONS[media_type]:
+                filename = f"{url_key}{extension}"
+                cache_entry = self.cache_index.get(filename)
+                if cache_entry is None:
+                    continue
+                try:
+                    file_obj = open(os.path.join(self.cache_dir, filename), 'rb')
+                except FileNotFoundError:
+                    # 文件已被外部删除，重新下载后会覆盖这条索引
+                    continue
+                logger.info("[MediaParser] 命中文件缓存: %s", filename)
+                return file_obj, filename, cache_entry[0]
+            
+            logger.info("[MediaParser] 开始下载%s: %s", media_type, url)
             response = self._make_request("GET", url, stream=True)
             if not response:
-                logger.error(f"[MediaParser] 下载失败: 无法获取响应")
-                return None, None
+                logger.error("[MediaParser] 下载失败: 无法获取响应")
+                return None, None, 0
 
             # 获取Content-Type和文件大小
-            content_type = response.headers.get('content-type', '').lower()
+            content_type = response.headers.get('content-type', '').split(';', 1)[0].strip().lower()
             content_length = response.headers.get('content-length')
-            logger.info(f"[MediaParser] 文件MIME类型: {content_type}, 预期大小: {content_length} bytes")
-            
-            # 验证Content-Type
-            if media_type == "video" and content_type not in self.video_extensions:
-                logger.error(f"[MediaParser] 不支持的视频类型: {content_type}")
-                return None, None
-            elif media_type == "image" and content_type not in self.image_extensions:
-                logger.error(f"[MediaParser] 不支持的图片类型: {content_type}")
-                return None, None
-
-            # 根据媒体类型选择扩展名
-            if media_type == "video":
-                extension = self.video_extensions.get(content_type, '.mp4')
-            else:
-                extension = self.image_extensions.get(content_type, '.jpg')
+            expected_size = int(content_length) if content_length and content_length.isdigit() else None
+            logger.debug("[MediaParser] 文件MIME类型: %s, 预期大小: %s bytes", content_type, content_length)
+            
+            # 声明大小已超出限制时不再下载响应体
+            if max_size is not None and expected_size is not None and expected_size > max_size:
+                logger.info("[MediaParser] 文件大小 %s 超出限制，跳过下载", self.format_size(expected_size))
+                response.close()
+                return None, None, expected_size
+            
+            # 验证Content-Type并确定扩展名
+            mime_info = MIME_EXTENSIONS.get(content_type)
+            if mime_info is None and content_type in GENERIC_CONTENT_TYPES:
+                url_extension = os.path.splitext(urlsplit(url).path)[1].lower()
+                mime_info = URL_EXTENSIONS.get(url_extension)
+            if mime_info is None or mime_info[0] != media_type:
+                logger.error("[MediaParser] 不支持的%s类型: %s", "视频" if media_type == "video" else "图片", content_type)
+                response.close()
+                return None, None, 0
+            extension = mime_info[1]
 
-            # 使用时间戳和随机数生成唯一文件名
-            filename = f"{int(time.time())}_{hash(url)}{extension}"
+            filename = f"{url_key}{extension}"
             filepath = os.path.join(self.cache_dir, filename)
+            # 先写入临时文件，完整写完后再改名，避免半截文件被当作缓存复用；
+            # 每次下载使用独立的临时文件，同一链接被并发下载时互不覆盖
+            # 创建时直接指定文件权限（受 umask 约束），无需再单独 chmod
+            temp_path = f"{filepath}.{secrets.token_hex(8)}.part"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
 
-            # 使用二进制模式写入文件
-            total_size = 0
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=self.config["cache"]["chunk_size"]):
-                    if chunk:
-                        f.write(chunk)
-                        total_size += len(chunk)
-
-            logger.info(f"[MediaParser] 文件下载成功: {filename}")
-            logger.info(f"[MediaParser] 文件路径: {filepath}")
-            logger.info(f"[MediaParser] 文件大小: {self.format_size(total_size)}")
+            # 图片和视频一样，只有声明了长度且不超过上限时才放在内存中，长度未知时直接写盘
+            in_memory = expected_size is not None and expected_size <= IN_MEMORY_MAX_BYTES
+            
+            # 由 shutil 在 C 层按块拷贝响应体，同时处理 gzip 等内容编码
+            response.raw.decode_content = True
+            file_obj = None
+            with open(fd, 'wb') as f:
+                if in_memory:
+                    # 先读入内存，再一次性写入缓存文件，直接返回内存中的数据
+                    file_obj = BytesIO()
+                    shutil.copyfileobj(response.raw, file_obj, self.chunk_size)
+                    total_size = file_obj.tell()
+                    with file_obj.getbuffer() as view:
+                        f.write(view)
+                    file_obj.seek(0)
+                else:
+                    # 大文件直接流式写入磁盘
+                    shutil.copyfileobj(response.raw, f, self.chunk_size)
+                    total_size = f.tell()
+            os.replace(temp_path, filepath)
+            temp_path = None
 
-            # 确保文件权限正确
-            try:
-                os.chmod(filepath, 0o644)
-            except Exception as e:
-                logger.warning(f"[MediaParser] 设置文件权限失败: {e}")
+            with self.cache_lock:
+                previous = self.cache_index.pop(filename, None)
+                if previous is not None:
+                    self.cache_total_size -= previous[0]
+                self.cache_index[filename] = (total_size, time.time())
+                self.cache_total_size += total_size
+            
+            logger.info("[MediaParser] 文件下载成功: %s, 大小: %s", filepath, self.format_size(total_size))
 
-            # 打开文件用于读取
-            file_obj = open(filepath, 'rb')
-            return file_obj, filename
+            # 写入磁盘的文件（大文件或长度未知）打开用于读取
+            if file_obj is None:
+                file_obj = open(filepath, 'rb', buffering=1 << 20)
+            return file_obj, filename, total_size
 
         except Exception as e:
-            logger.error(f"[MediaParser] 下载媒体文件失败: {e}")
-            import traceback
-            logger.error(f"[MediaParser] 错误追踪: {traceback.format_exc()}")
-            return None, None
+            logger.error("[MediaParser] 下载媒体文件失败: %s", e, exc_info=True)
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return None, None, 0
 
     def close_file(self, file_obj):
         """安全地关闭文件对象"""
         try:
-            if hasattr(file_obj, '_filepath'):
-                filepath = getattr(file_obj, '_filepath')
+            filepath = getattr(file_obj, '_filepath', None)
+            if filepath:
                 if os.path.exists(filepath):
                     try:
                         os.remove(filepath)
-                        logger.debug(f"[MediaParser] 删除缓存文件: {filepath}")
+                        logger.debug("[MediaParser] 删除缓存文件: %s", filepath)
                     except Exception as e:
-                        logger.warning(f"[MediaParser] 删除缓存文件失败: {e}")
-            if hasattr(file_obj, 'close'):
-                file_obj.close()
+                        logger.warning("[MediaParser] 删除缓存文件失败: %s", e)
+            close = getattr(file_obj, 'close', None)
+            if close is not None:
+                close()
         except Exception as e:
-            logger.error(f"[MediaParser] 关闭文件失败: {e}")
+            logger.error("[MediaParser] 关闭文件失败: %s", e)
+
+    def _scan_cache(self):
+        """单次遍历缓存目录，返回 [(创建时间, 大小, 路径)]"""
+        files = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat()
+                    files.append((stat.st_ctime, stat.st_size, entry.path))
+        return files
+
+    def _remove_cache_file(self, filename):
+        """删除单个缓存文件，返回是否删除成功"""
+        filepath = os.path.join(self.cache_dir, filename)
+        try:
+            os.remove(filepath)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.error("[MediaParser] 删除缓存文件失败: %s, 错误: %s", filepath, e)
+            return False
 
     def _clear_expired_cache(self):
         """清理过期缓存"""
         try:
             logger.info("[MediaParser] 开始清理过期缓存")
-            max_age = self.config["cache"]["max_age_hours"] * 3600  # 转换为秒
             current_time = time.time()
+            expired = []
+            
+            # 锁内只摘除索引条目，删除文件放到锁外进行
+            with self.cache_lock:
+                # 索引按创建时间排序，遇到第一个未过期的文件即可停止
+                while self.cache_index:
+                    filename, (size, ctime) = next(iter(self.cache_index.items()))
+                    if current_time - ctime <= self.max_cache_age:
+                        break
+                    del self.cache_index[filename]
+                    self.cache_total_size -= size
+                    expired.append((filename, size, current_time - ctime))
+            
             removed_count = 0
             removed_size = 0
-            
-            for filename in os.listdir(self.cache_dir):
-                filepath = os.path.join(self.cache_dir, filename)
-                if os.path.isfile(filepath):
-                    # 检查文件年龄
-                    file_age = current_time - os.path.getctime(filepath)
-                    if file_age > max_age:
-                        try:
-                            size = os.path.getsize(filepath)
-                            os.remove(filepath)
-                            removed_count += 1
-                            removed_size += size
-                            logger.info(f"[MediaParser] 删除过期文件: {filepath}, 年龄: {int(file_age/3600)}小时")
-                        except Exception as e:
-                            logger.error(f"[MediaParser] 删除过期文件失败: {filepath}, 错误: {e}")
+            for filename, size, file_age in expired:
+                if self._remove_cache_file(filename):
+                    removed_count += 1
+                    removed_size += size
+                    logger.info("[MediaParser] 删除过期文件: %s, 年龄: %s小时", filename, int(file_age/3600))
             
             if removed_count > 0:
-                logger.info(f"[MediaParser] 清理完成，删除了 {removed_count} 个文件，总大小: {self.format_size(removed_size)}")
+                logger.info("[MediaParser] 清理完成，删除了 %s 个文件，总大小: %s", removed_count, self.format_size(removed_size))
             else:
                 logger.info("[MediaParser] 没有发现过期文件")
                 
         except Exception as e:
-            logger.error(f"[MediaParser] 清理过期缓存失败: {e}", exc_info=True)
+            logger.error("[MediaParser] 清理过期缓存失败: %s", e, exc_info=True)
 
     def _check_cache_size(self):
         """检查并控制缓存大小"""
+        max_size = self.max_cache_size
+        # 缓存总大小是增量维护的，未超限时直接返回
+        if self.cache_total_size <= max_size:
+            return
+        
         try:
-            logger.info("[MediaParser] 开始检查缓存大小")
-            total_size = 0
-            files = []
-            
-            # 获取所有缓存文件信息
-            for filename in os.listdir(self.cache_dir):
-                filepath = os.path.join(self.cache_dir, filename)
-                if os.path.isfile(filepath):
-                    size = os.path.getsize(filepath)
-                    ctime = os.path.getctime(filepath)
-                    files.append((filepath, size, ctime))
-                    total_size += size
-            
-            max_size = self.config["cache"]["max_size_mb"] * 1024 * 1024  # 转换为字节
-            logger.info(f"[MediaParser] 当前缓存大小: {self.format_size(total_size)}, 最大限制: {self.format_size(max_size)}")
-            
-            if total_size > max_size:
-                # 按创建时间排序，删除最旧的文件
-                files.sort(key=lambda x: x[2])  # 按创建时间排序
-                
-                # 删除文件直到缓存大小小于限制
-                while total_size > max_size and files:
-                    filepath, size, _ = files.pop(0)
-                    try:
-                        os.remove(filepath)
-                        total_size -= size
-                        logger.info(f"[MediaParser] 删除缓存文件: {filepath}, 大小: {self.format_size(size)}")
-                    except Exception as e:
-                        logger.error(f"[MediaParser] 删除缓存文件失败: {filepath}, 错误: {e}")
+            evicted = []
+            with self.cache_lock:
+                logger.info("[MediaParser] 当前缓存大小: %s, 最大限制: %s", self.format_size(self.cache_total_size), self.format_size(max_size))
                 
-                logger.info(f"[MediaParser] 清理后的缓存大小: {self.format_size(total_size)}")
+                # 从索引头部依次摘除最旧的文件，直到缓存大小小于限制
+                while self.cache_total_size > max_size and self.cache_index:
+                    filename, (size, _) = self.cache_index.popitem(last=False)
+                    self.cache_total_size -= size
+                    evicted.append((filename, size))
+                remaining_size = self.cache_total_size
+            
+            for filename, size in evicted:
+                if self._remove_cache_file(filename):
+                    logger.info("[MediaParser] 删除缓存文件: %s, 大小: %s", filename, self.format_size(size))
+            
+            logger.info("[MediaParser] 清理后的缓存大小: %s", self.format_size(remaining_size))
             
         except Exception as e:
-            logger.error(f"[MediaParser] 检查缓存大小失败: {e}", exc_info=True)
+            logger.error("[MediaParser] 检查缓存大小失败: %s", e, exc_info=True)
             
     def clean_cache(self):
         """清理所有缓存"""
         try:
             with self.cache_lock:
-                files = [f for f in os.listdir(self.cache_dir) 
-                        if os.path.isfile(os.path.join(self.cache_dir, f))]
-                total_size = sum(os.path.getsize(os.path.join(self.cache_dir, f)) 
-                               for f in files)
-                
-                for f in files:
-                    try:
-                        os.remove(os.path.join(self.cache_dir, f))
-                    except OSError as e:
-                        logger.error(f"[MediaParser] 删除文件失败: {e}")
+                filenames = list(self.cache_index)
+                total_size = self.cache_total_size
+                self.cache_index.clear()
+                self.cache_total_size = 0
+            
+            for filename in filenames:
+                self._remove_cache_file(filename)
+            
+            with self.api_cache_lock:
+                api_entries = len(self.api_cache)
+                self.api_cache.clear()
                         
-            return f"缓存已清理\n清理前：{len(files)}个文件，{self.format_size(total_size)}"
+            return f"缓存已清理\n清理前：{len(filenames)}个文件，{self.format_size(total_size)}，{api_entries}条解析结果"
                 
         except Exception as e:
-            logger.error(f"[MediaParser] 清理缓存失败: {e}")
+            logger.error("[MediaParser] 清理缓存失败: %s", e)
             return "清理缓存失败，请稍后重试"
 
     def cache_status(self):
         """获取缓存状态"""
         try:
             with self.cache_lock:
-                files = [f for f in os.listdir(self.cache_dir) 
-                        if os.path.isfile(os.path.join(self.cache_dir, f))]
-                total_size = sum(os.path.getsize(os.path.join(self.cache_dir, f)) 
-                               for f in files)
-                
-                max_size = self.config["cache"]["max_size_mb"]
-                max_age = self.config["cache"]["max_age_hours"]
-                
-                status = f"缓存状态：\n"
-                status += f"文件数：{len(files)}\n"
-                status += f"占用空间：{self.format_size(total_size)}\n"
-                status += f"最大空间：{max_size}MB\n"
-                status += f"过期时间：{max_age}小时"
-                
-                return status
+                file_count = len(self.cache_index)
+                total_size = self.cache_total_size
+            with self.api_cache_lock:
+                api_entries = len(self.api_cache)
+            
+            max_size = self.config["cache"]["max_size_mb"]
+            max_age = self.config["cache"]["max_age_hours"]
+            
+            status = f"缓存状态：\n"
+            status += f"文件数：{file_count}\n"
+            status += f"占用空间：{self.format_size(total_size)}\n"
+            status += f"最大空间：{max_size}MB\n"
+            status += f"过期时间：{max_age}小时\n"
+            status += f"解析结果缓存：{api_entries}条"
+            
+            return status
                 
         except Exception as e:
-            logger.error(f"[MediaParser] 获取缓存状态失败: {e}")
+            logger.error("[MediaParser] 获取缓存状态失败: %s", e)
             return "获取缓存状态失败，请稍后重试"
 
     def format_size(self, size):
         """格式化文件大小"""
-        units = ['B', 'KB', 'MB', 'GB']
+        # 由二进制位数直接确定单位，每级 1024 即 10 位
         unit_index = 0
-        while size >= 1024 and unit_index < len(units) - 1:
-            size /= 1024
-            unit_index += 1
-        return f"{size:.2f} {units[unit_index]}"
-
-    def _process_pending_tasks(self):
-        """后台线程处理待发送的任务"""
-        while not self.stop_event.is_set():
-            try:
-                current_time = time.time()
-                tasks_to_remove = []
-                
-                with self.tasks_lock:
-                    for task_id, task in self.processing_tasks.items():
-                        if current_time >= task['next_send_time']:
-                            # 获取下一个要发送的回复
-                            reply = task['replies'][task['index']]
-                            receiver = task['receiver']  # 从任务中获取接收者信息
-                            
-                            try:
-                                # 发送回复
-                                self.send_to_channel(reply, receiver)
-                                logger.debug(f"[MediaParser] 发送成功: {reply}")
-                                
-                                # 更新任务状态
-                                task['index'] += 1
-                                if task['index'] >= len(task['replies']):
-                                    # 所有回复都已发送完成
-                                    tasks_to_remove.append(task_id)
-                                    logger.info(f"[MediaParser] 任务完成: {task_id}")
-                                else:
-                                    # 设置下一次发送时间
-                                    task['next_send_time'] = current_time + self.config["batch"]["delay_seconds"]
-                                    
-                            except Exception as e:
-                                logger.error(f"[MediaParser] 发送失败: {e}")
-                                # 发送失败时也移除任务
-                                tasks_to_remove.append(task_id)
-                    
-                    # 清理已完成的任务
-                    for task_id in tasks_to_remove:
-                        task = self.processing_tasks.pop(task_id)
-                        # 清理相关的文件对象
-                        if 'replies' in task:
-                            self.clean_up_files(task['replies'])
-                
-            except Exception as e:
-                logger.error(f"[MediaParser] 处理任务出错: {e}")
+        if size >= 1024:
+            unit_index = min((int(size).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+        return f"{size / (1 << (unit_index * 10)):.2f} {SIZE_UNITS[unit_index]}"
+
+    def add_task(self, task_id, replies, receiver):
+        """添加待发送任务，由后台线程按批次间隔依次发送"""
+        task = PendingTask(task_id, replies, receiver)
+        self._schedule_task(task, time.monotonic())
+
+    def _schedule_task(self, task, send_time):
+        """将任务按发送时间放入堆中并唤醒后台线程"""
+        with self.tasks_cv:
+            heapq.heappush(self.pending_tasks, (send_time, next(self.task_seq), task))
+            self.tasks_cv.notify()
+
+    def _run_task(self, task):
+        """执行一个到期的任务，由后台线程在不持有锁时调用，避免阻塞新任务入队"""
+        if task is CACHE_CLEANUP_TASK:
+            self._clear_expired_cache()
+            self._schedule_task(CACHE_CLEANUP_TASK, time.monotonic() + self.cache_cleanup_interval)
+            return
+        
+        try:
+            # 每批最多发送 image_limit 张图片（连同各自的说明），批次之间间隔 delay_seconds
+            batch_end = image_batch_end(task.replies, task.index, self.batch_size)
+            batch = task.replies[task.index:batch_end]
+            self.send_to_channel(batch, task.receiver)
+            logger.debug("[MediaParser] 发送成功: %s条", len(batch))
+            
+            # 更新任务状态，未发送完则安排下一批
+            task.index += len(batch)
+            if task.index < len(task.replies):
+                self._schedule_task(task, time.monotonic() + self.batch_delay)
+                return
+            logger.info("[MediaParser] 任务完成: %s", task.task_id)
             
-            # 短暂休眠以避免过度占用CPU
-            time.sleep(0.1)
+        except Exception as e:
+            # 发送失败时也移除任务
+            logger.error("[MediaParser] 发送失败: %s", e)
+        
+        # 清理相关的文件对象
+        self.clean_up_files(task.replies)
 
     def send_reply(self, reply):
         """发送Reply对象的辅助方法"""
         try:
             # 假设 context 中包含 receiver 信息
             receiver = reply.receiver  # 确保 Reply 对象包含 receiver 属性
-            logger.debug(f"[MediaParser] 发送Reply类型: {reply.type}, 内容: {reply.content}")
+            logger.debug("[MediaParser] 发送Reply类型: %s, 内容: %s", reply.type, reply.content)
             self.send_to_channel(reply, receiver)
             # 发送完成后关闭文件对象
             self.clean_up_files([reply])
         except Exception as e:
-            logger.error(f"[MediaParser] 发送Reply失败: {e}")
+            logger.error("[MediaParser] 发送Reply失败: %s", e)
 
-    def send_to_channel(self, reply, receiver):
-        """发送Reply对象到目标频道"""
+    def send_to_channel(self, replies, receiver):
+        """发送Reply对象（或Reply列表）到目标频道，列表共用同一个channel和context；文件由调用方通过 clean_up_files 关闭"""
+        if not isinstance(replies, list):
+            replies = [replies]
         try:
-            from channel.channel_factory import create_channel
-            from bridge.context import Context
-            from bridge.reply import ReplyType
-            
-            logger.info(f"[MediaParser] 准备发送Reply: 类型={reply.type}, 接收者={receiver}")
+            logger.info("[MediaParser] 准备发送%s条Reply: 接收者=%s", len(replies), receiver)
             
-            channel = create_channel("wx")
+            channel = self._get_channel()
             if channel:
                 context = Context()
                 context.kwargs = {'receiver': receiver}
                 
-                if reply.type in [ReplyType.IMAGE, ReplyType.VIDEO]:
-                    # 确保文件存在且可读
-                    if hasattr(reply.content, 'name'):
-                        if not os.path.exists(reply.content.name):
-                            logger.error(f"[MediaParser] 文件不存在: {reply.content.name}")
-                            return
-                        
-                        # 重新打开文件以确保它是可读的
-                        try:
-                            reply.content.close()
-                            reply.content = open(reply.content.name, 'rb')
-                        except Exception as e:
-                            logger.error(f"[MediaParser] 重新打开文件失败: {e}")
-                            return
-                
-                try:
-                    channel.send(reply, context)
-                    logger.info(f"[MediaParser] 发送成功: {reply}")
-                except Exception as send_error:
-                    logger.error(f"[MediaParser] 发送失败: {send_error}")
-                    import traceback
-                    logger.error(f"[MediaParser] 错误追踪: {traceback.format_exc()}")
-                finally:
-                    # 确保文件被关闭
-                    if reply.type in [ReplyType.IMAGE, ReplyType.VIDEO]:
-                        try:
-                            reply.content.close()
-                        except:
-                            pass
+                # channel 支持批量发送时一次提交整批回复
+                send_batch = getattr(channel, 'send_batch', None)
+                if send_batch and len(replies) > 1:
+                    ready = [reply for reply in replies if self._prepare_reply(reply)]
+                    try:
+                        send_batch(ready, context)
+                        logger.info("[MediaParser] 批量发送成功: %s条", len(ready))
+                    except Exception as send_error:
+                        logger.exception("[MediaParser] 批量发送失败: %s", send_error)
+                else:
+                    for reply in replies:
+                        if self._prepare_reply(reply):
+                            self._send_single(channel, reply, context)
             else:
                 logger.error("[MediaParser] 未找到微信channel")
                 raise RuntimeError("未找到微信channel")
         
         except Exception as e:
-            logger.error(f"[MediaParser] 发送失败: {e}")
-            import traceback
-            logger.error(f"[MediaParser] 错误追踪: {traceback.format_exc()}")
+            logger.exception("[MediaParser] 发送失败: %s", e)
+
+    def _get_channel(self):
+        """获取微信channel，首次使用时创建，之后复用"""
+        channel = self.wx_channel
+        if channel is None:
+            # 加锁后再检查一次，避免多个线程同时创建channel
+            with self.wx_channel_lock:
+                channel = self.wx_channel
+                if channel is None:
+                    from channel.channel_factory import create_channel
+                    channel = self.wx_channel = create_channel("wx")
+        return channel
+
+    def _prepare_reply(self, reply):
+        """发送前确保媒体文件可从头读取，返回是否可以发送"""
+        if reply.type in MEDIA_TYPES:
+            seek = getattr(reply.content, 'seek', None)
+            if seek is None:
+                return True
+            # 文件对象仍然可用时回到开头即可，已关闭时才按文件名重新打开
+            try:
+                seek(0)
+            except (ValueError, OSError):
+                name = getattr(reply.content, 'name', None)
+                if not isinstance(name, str):
+                    logger.error("[MediaParser] 文件对象已关闭，无法发送")
+                    return False
+                try:
+                    reply.content = open(name, 'rb')
+                except OSError as e:
+                    logger.error("[MediaParser] 重新打开文件失败: %s", e)
+                    return False
+        return True
+
+    def _send_single(self, channel, reply, context):
+        """通过channel发送单条Reply"""
+        try:
+            channel.send(reply, context)
+            logger.info("[MediaParser] 发送成功: %s", reply)
+        except Exception as send_error:
+            logger.exception("[MediaParser] 发送失败: %s", send_error)
 
     def clean_up_files(self, reply_list):
-        """在所有回复发送完成后关闭文件对象"""
+        """在所有回复发送完成后关闭文件对象，同一文件对象只关闭一次"""
+        seen = set()
         for reply in reply_list:
-            if reply.type in [ReplyType.IMAGE, ReplyType.VIDEO]:
+            if reply.type in MEDIA_TYPES:
+                content_id = id(reply.content)
+                if content_id in seen:
+                    continue
+                seen.add(content_id)
                 try:
                     self.close_file(reply.content)
                 except Exception as e:
-                    logger.error(f"[MediaParser] 关闭文件失败: {e}")
+                    logger.error("[MediaParser] 关闭文件失败: %s", e)
 
-    def __del__(self):
-        """清理资源"""
+    def close(self, timeout=5, wait=True):
+        """停止后台线程，取消排队中的下载；wait 为真时在限定时间内等待后台线程和进行中的下载结束"""
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        with self.tasks_cv:
+            self.tasks_cv.notify_all()
+        
+        # 第一阶段：不再接受新任务并取消尚未开始的下载
         try:
-            self.stop_event.set()
-            self.worker_thread.join(timeout=5)
-            self.session.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:  # Python 3.9 以下不支持 cancel_futures
             self.executor.shutdown(wait=False)
+        if not wait:
+            return
+        
+        # 第二阶段：在限定时间内等待后台线程和进行中的下载结束
+        deadline = time.time() + timeout
+        self.worker_thread.join(timeout=timeout)
+        waiter = threading.Thread(target=self.executor.shutdown, daemon=True)
+        waiter.start()
+        waiter.join(timeout=max(deadline - time.time(), 0))
+
+    def __del__(self):
+        """清理资源，只发出停止信号，不等待后台线程"""
+        try:
+            self.close(wait=False)
         except Exception as e:
-            logger.error(f"[MediaParser] 关闭资源失败: {e}")
+            logger.error("[MediaParser] 关闭资源失败: %s", e)
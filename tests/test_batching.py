@@ -0,0 +1,118 @@
+import enum
+import importlib.util
+import logging
+import os
+import sys
+import types
+import unittest
+
+
+def _install_host_modules():
+    """插件运行在 chatgpt-on-wechat 中，测试时提供它所需的最小宿主模块"""
+    if "bridge.reply" in sys.modules:
+        return
+
+    class ReplyType(enum.Enum):
+        TEXT = 1
+        IMAGE = 2
+        VIDEO = 3
+
+    class Reply:
+        def __init__(self, type=None, content=None):
+            self.type = type
+            self.content = content
+
+    bridge = types.ModuleType("bridge")
+    reply = types.ModuleType("bridge.reply")
+    reply.Reply = Reply
+    reply.ReplyType = ReplyType
+    context = types.ModuleType("bridge.context")
+    context.ContextType = enum.Enum("ContextType", "TEXT")
+    context.Context = type("Context", (), {})
+    common = types.ModuleType("common")
+    log = types.ModuleType("common.log")
+    log.logger = logging.getLogger("media_parser_test")
+    plugins = types.ModuleType("plugins")
+    plugins.register = lambda **kwargs: (lambda cls: cls)
+    plugins.Plugin = type("Plugin", (), {})
+    plugins.Event = enum.Enum("Event", "ON_HANDLE_CONTEXT")
+    plugins.EventContext = dict
+    plugins.EventAction = enum.Enum("EventAction", "BREAK_PASS")
+
+    sys.modules.update({
+        "bridge": bridge,
+        "bridge.reply": reply,
+        "bridge.context": context,
+        "common": common,
+        "common.log": log,
+        "plugins": plugins,
+    })
+
+
+def _load_parser():
+    _install_host_modules()
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "parser.py")
+    spec = importlib.util.spec_from_file_location("media_parser_parser", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+parser = _load_parser()
+Reply = parser.Reply
+ReplyType = parser.ReplyType
+
+
+def album_replies(image_count):
+    """按 parse_images 的顺序构造图集后续回复：每张图片前一条说明，最后一条完成提示"""
+    replies = []
+    for index in range(1, image_count + 1):
+        replies.append(Reply(ReplyType.TEXT, f"图片 {index}/{image_count}"))
+        replies.append(Reply(ReplyType.IMAGE, object()))
+    replies.append(Reply(ReplyType.TEXT, "图集发送完成"))
+    return replies
+
+
+def split_batches(replies, image_limit):
+    """按后台线程的方式切分批次"""
+    batches = []
+    index = 0
+    while index < len(replies):
+        end = parser.image_batch_end(replies, index, image_limit)
+        batches.append(replies[index:end])
+        index = end
+    return batches
+
+
+def image_count(batch):
+    return sum(1 for reply in batch if reply.type == ReplyType.IMAGE)
+
+
+class ImageBatchTest(unittest.TestCase):
+
+    def test_each_batch_holds_image_limit_images(self):
+        batches = split_batches(album_replies(25), 10)
+        self.assertEqual([image_count(batch) for batch in batches], [10, 10, 5])
+
+    def test_caption_stays_with_its_image(self):
+        for batch in split_batches(album_replies(25), 10):
+            for position, reply in enumerate(batch):
+                if reply.type == ReplyType.IMAGE:
+                    self.assertGreater(position, 0)
+                    self.assertTrue(batch[position - 1].content.startswith("图片"))
+            # 说明不会被留在批次末尾而与图片分开
+            self.assertFalse(batch[-1].type == ReplyType.TEXT and batch[-1].content.startswith("图片"))
+
+    def test_completion_notice_joins_last_batch(self):
+        batches = split_batches(album_replies(20), 10)
+        self.assertEqual([image_count(batch) for batch in batches], [10, 10])
+        self.assertEqual(batches[-1][-1].content, "图集发送完成")
+
+    def test_all_replies_sent_once_in_order(self):
+        replies = album_replies(7)
+        batches = split_batches(replies, 3)
+        self.assertEqual([reply for batch in batches for reply in batch], replies)
+
+
+if __name__ == "__main__":
+    unittest.main()